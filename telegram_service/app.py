@@ -1,11 +1,29 @@
 # telegram_service/app.py
-from flask import Flask, request, jsonify
-from telethon.sync import TelegramClient
+from quart import Quart, Response, request
+from telethon import TelegramClient, utils
+from telethon.errors import ChannelPrivateError
+from telethon.sessions import MemorySession, SQLiteSession
+from telethon.tl.types import (
+    PeerUser, PeerChat, PeerChannel, ChannelForbidden,
+    MessageMediaPhoto, MessageMediaDocument,
+    DocumentAttributeVideo, DocumentAttributeAudio, DocumentAttributeImageSize
+)
 import os
+import sys
+import re
 import asyncio
+import sqlite3
+import time
 from datetime import datetime, timedelta, timezone
+from operator import itemgetter
 from dotenv import load_dotenv
-import threading
+import logging
+try:
+    import ahocorasick
+except ImportError:  # Optional: fall back to a compiled regex alternation
+    ahocorasick = None
+import orjson
+from async_lru import alru_cache
 
 # Load environment variables
 load_dotenv()
@@ -15,297 +33,572 @@ API_ID = int(os.getenv('TELEGRAM_API_ID'))
 API_HASH = os.getenv('TELEGRAM_API_HASH')
 PHONE = os.getenv('TELEGRAM_PHONE_NUMBER')
 SESSION = os.getenv('TELEGRAM_SESSION_NAME', 'telegram_session')
+SESSION_FLUSH_INTERVAL = 60  # Seconds between writes of the in-memory session to disk
+ENTITY_CACHE_TTL = 300  # Seconds a resolved channel (and its title/username) is reused
 
 # New configuration for forwarding
 TARGET_CHANNEL = os.getenv('TARGET_CHANNEL')  # Channel username or ID where messages will be forwarded
 KEYWORDS = 'حمله هوایی,موشک,پهپاد,جنگنده,بمب افکن,پدافند هوایی,دفاع هوایی,رهگیری,قطع برق,خاموشی,قطع آب,کمبود آب,انفجار,صدای انفجار,آتش سوزی,حادثه,موشک,پدافند,بمب,راکت,صدا,منفجر,دیده شد,حمله,لرزید'  # Comma-separated keywords to trigger forwarding
 TEST_LENGTH_LIMIT = 400
+_TEHRAN_OFFSET = timedelta(hours=3, minutes=30)  # Reported dates are shifted to Tehran time
 
-# Initialize Flask app
-app = Flask(__name__)
-
-# Thread-local storage for event loops
-thread_local = threading.local()
-
-def get_event_loop():
-    """Get or create an event loop for the current thread"""
-    if not hasattr(thread_local, "loop"):
-        thread_local.loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(thread_local.loop)
-    return thread_local.loop
-
-# Initialize Telegram client in the main thread
-print("Connecting to Telegram...")
-loop = get_event_loop()
-with TelegramClient(SESSION, API_ID, API_HASH, loop=loop) as client:
-    if not client.is_user_authorized():
-        print("Need to authenticate with Telegram...")
-        client.send_code_request(PHONE)
+# Parse the keywords once instead of on every message. They are all Persian, which has
+# no letter case, so neither the keywords nor the messages are lowercased (if English
+# keywords are ever added, lowercase both again or compile _KW_RE with re.IGNORECASE)
+KEYWORDS_LIST = tuple(k.strip() for k in KEYWORDS.split(',') if 0 < len(k.strip()) < TEST_LENGTH_LIMIT)
+
+# Build the keyword automaton once so each message is scanned in a single pass
+_AC = None
+_KW_RE = None
+if ahocorasick is not None:
+    _AC = ahocorasick.Automaton()
+    for keyword in KEYWORDS_LIST:
+        _AC.add_word(keyword, keyword)
+    _AC.make_automaton()
+else:
+    # Longest keywords first so overlapping alternatives resolve quickly
+    _KW_RE = re.compile('|'.join(sorted((re.escape(k) for k in KEYWORDS_LIST), key=len, reverse=True)))
+
+# Log at INFO by default; set LOG_LEVEL=DEBUG to trace individual messages
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'))
+logger = logging.getLogger(__name__)
+
+# Fields copied from each document attribute type into the media info
+_ATTR_HANDLERS = {
+    DocumentAttributeVideo: lambda a, m: m.update(duration=a.duration, width=a.w, height=a.h),
+    DocumentAttributeAudio: lambda a, m: m.update(duration=a.duration, title=a.title, performer=a.performer),
+    DocumentAttributeImageSize: lambda a, m: m.update(width=a.w, height=a.h),
+}
+
+# Reported type names for the common media classes, avoiding a __name__ lookup per message
+_MEDIA_TYPE = {
+    MessageMediaPhoto: 'MessageMediaPhoto',
+    MessageMediaDocument: 'MessageMediaDocument',
+}
+
+# Initialize Quart app
+app = Quart(__name__)
+
+def ojsonify(obj, status=200):
+    """Serialize a response body with orjson"""
+    return Response(orjson.dumps(obj, default=str), status=status, mimetype='application/json')
+
+async def stream_messages(payload):
+    """Yield a /get-messages response as JSON chunks, serializing one message at a time
+
+    The payload is already built in memory, so this only splits up serialization;
+    it does not lower peak memory. Keys come out in the same order as ojsonify.
+    """
+    keys = list(payload)
+    split = keys.index('messages')
+    head = {key: payload[key] for key in keys[:split]}
+    tail = {key: payload[key] for key in keys[split + 1:]}
+    # Splice the other fields around the array by trimming their outer braces
+    yield (orjson.dumps(head, default=str)[:-1] + b',' if head else b'{') + b'"messages":['
+    for i, message_dict in enumerate(payload['messages']):
+        if i:
+            yield b','
+        yield orjson.dumps(message_dict, default=str)
+    yield b']' + (b',' + orjson.dumps(tail, default=str)[1:] if tail else b'}')
+
+# The clients stay connected for the life of the process and are shared by all routes.
+# They are created in before_serving so they live on the same event loop as the app.
+# Reads (entities, history) and writes (forwards) use separate connections so a slow
+# fetch cannot hold up forwarding.
+# Both clients run on in-memory sessions loaded from the session file, so RPCs never
+# wait on SQLite writes; the login and any changed entities are copied back to the
+# file periodically from a worker thread.
+read_client = None
+write_client = None
+disk_session = None
+flush_task = None
+
+def copy_session(source, target):
+    """Copy the data center and auth key from one session to another"""
+    if source.server_address:
+        target.set_dc(source.dc_id, source.server_address, source.port)
+    target.auth_key = source.auth_key
+
+class EntityMemorySession(MemorySession):
+    """MemorySession that keeps the latest row per entity and tracks which rows changed
+
+    Rows are (id, hash, username, phone, name, date), the columns of the entities
+    table in a session file, so they can be loaded from and flushed back to it.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._entity_rows = {}
+        self._changed_ids = set()
+
+    def load_entity_rows(self, rows):
+        """Add rows read from a session file without marking them as changed"""
+        for row in rows:
+            self._entity_rows[row[0]] = tuple(row)
+
+    def pop_changed_rows(self):
+        """Return the rows changed since the last call and reset the change set"""
+        rows = [self._entity_rows[entity_id] for entity_id in self._changed_ids]
+        self._changed_ids.clear()
+        return rows
+
+    def restore_changed_rows(self, rows):
+        """Mark rows as changed again after a failed flush"""
+        self._changed_ids.update(row[0] for row in rows)
+
+    def process_entities(self, tlo):
+        now = int(time.time())
+        for row in self._entities_to_rows(tlo):
+            current = self._entity_rows.get(row[0])
+            if current is None or current[:5] != row:
+                self._entity_rows[row[0]] = row + (now,)
+                self._changed_ids.add(row[0])
+
+    def _find_entity(self, predicate):
+        return next(((row[0], row[1]) for row in self._entity_rows.values() if predicate(row)), None)
+
+    def get_entity_rows_by_phone(self, phone):
+        return self._find_entity(lambda row: row[3] == phone)
+
+    def get_entity_rows_by_username(self, username):
+        # A username can move between entities; like SQLiteSession, prefer the newest row
+        rows = [row for row in self._entity_rows.values() if row[2] == username]
+        if rows:
+            row = max(rows, key=lambda r: r[5] or 0)
+            return row[0], row[1]
+
+    def get_entity_rows_by_name(self, name):
+        return self._find_entity(lambda row: row[4] == name)
+
+    def get_entity_rows_by_id(self, id, exact=True):
+        if exact:
+            row = self._entity_rows.get(id)
+            return (row[0], row[1]) if row else None
+        ids = (
+            utils.get_peer_id(PeerUser(id)),
+            utils.get_peer_id(PeerChat(id)),
+            utils.get_peer_id(PeerChannel(id))
+        )
+        return self._find_entity(lambda row: row[0] in ids)
+
+def memory_session(source, session_class=MemorySession):
+    """Create an in-memory session with the same login as source"""
+    session = session_class()
+    copy_session(source, session)
+    return session
+
+def read_entity_rows(filename):
+    """Read every row of the entities table in a session file"""
+    conn = sqlite3.connect(filename)
+    try:
+        return conn.execute('select id, hash, username, phone, name, date from entities').fetchall()
+    finally:
+        conn.close()
+
+def flush_session(rows):
+    """Persist the read client's login and the given entity rows to the session file"""
+    copy_session(read_client.session, disk_session)
+    disk_session.save()
+    if not rows:
+        return
+    conn = sqlite3.connect(disk_session.filename)
+    try:
+        with conn:
+            conn.executemany('insert or replace into entities values (?,?,?,?,?,?)', rows)
+    finally:
+        conn.close()
+
+async def flush_session_every(interval):
+    """Flush the session to disk every interval seconds without blocking the event loop"""
+    session = read_client.session
+    while True:
+        await asyncio.sleep(interval)
+        rows = session.pop_changed_rows()
+        try:
+            await asyncio.to_thread(flush_session, rows)
+        except asyncio.CancelledError:
+            session.restore_changed_rows(rows)
+            raise
+        except Exception as e:
+            session.restore_changed_rows(rows)
+            logger.warning("Could not save Telegram session: %s", e)
+
+@app.before_serving
+async def connect_clients():
+    """Connect to Telegram, authenticating on first run"""
+    global read_client, write_client, disk_session, flush_task
+    logger.info("Connecting to Telegram...")
+    disk_session = SQLiteSession(SESSION)
+    read_session = memory_session(disk_session, EntityMemorySession)
+    read_session.load_entity_rows(read_entity_rows(disk_session.filename))
+    read_client = TelegramClient(read_session, API_ID, API_HASH)
+    await read_client.connect()
+    if not await read_client.is_user_authorized():
+        logger.info("Need to authenticate with Telegram...")
+        if not sys.stdin.isatty():
+            # Hypercorn workers run in a spawned process whose stdin is /dev/null
+            raise RuntimeError(
+                "Telegram login required but stdin is not a terminal; "
+                "run 'python app.py' once to sign in, then start the server again"
+            )
+        await read_client.send_code_request(PHONE)
         code = input('Enter the code you received: ')
-        client.sign_in(PHONE, code)
-    print("Connected to Telegram successfully!")
+        await read_client.sign_in(PHONE, code)
+        flush_session(read_session.pop_changed_rows())
+
+    write_client = TelegramClient(memory_session(read_client.session), API_ID, API_HASH)
+    await write_client.connect()
+    flush_task = asyncio.create_task(flush_session_every(SESSION_FLUSH_INTERVAL))
+    logger.info("Connected to Telegram successfully!")
 
-# Keep track of last check time
+@app.after_serving
+async def disconnect_clients():
+    """Close the Telegram connections on shutdown"""
+    # connect_clients may have failed partway, so only tear down what was set up
+    if flush_task is not None:
+        flush_task.cancel()
+        try:
+            await flush_task
+        except asyncio.CancelledError:
+            pass
+    if write_client is not None:
+        await write_client.disconnect()
+    if read_client is not None:
+        await read_client.disconnect()
+        if disk_session is not None:
+            flush_session(read_client.session.pop_changed_rows())
+    if disk_session is not None:
+        disk_session.close()
+
+@alru_cache(maxsize=512, ttl=ENTITY_CACHE_TTL)
+async def _entity(name):
+    """Resolve a channel to its entity, caching the result across requests"""
+    return await read_client.get_entity(name)
+
+async def invalidate_unusable_entities(*names):
+    """Drop the cached entities of the channels that no longer resolve to a usable channel"""
+    for name in names:
+        try:
+            fresh = await read_client.get_entity(name)
+        except (ChannelPrivateError, ValueError):
+            fresh = None
+        if fresh is None or isinstance(fresh, ChannelForbidden):
+            logger.debug("Dropping cached entity for %s", name)
+            _entity.cache_invalidate(name)
+
+# Keep track of last check time (UTC)
 last_check_time = datetime.now(timezone.utc)
 
 def should_forward_message(message_text):
-    """Check if a message contains any of the specified keywords"""
-    if not KEYWORDS or not message_text:
-        return False
-    message_text = message_text.lower()
-    print(f"Checking message: {message_text}")
-    print(f"Keywords: {KEYWORDS}")
-    print(f"Keywords split: {KEYWORDS.split(',')}")
-    return any(keyword.strip() in message_text for keyword in KEYWORDS.split(',') if len(keyword.strip()) < TEST_LENGTH_LIMIT)
-
-async def forward_message(client, message, target_channel):
-    """Forward a message to the target channel"""
+    """Check if a non-empty message contains any of the specified keywords"""
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Checking message: %s", message_text)
+    if _KW_RE is not None:
+        return _KW_RE.search(message_text) is not None
+    return any(True for _ in _AC.iter(message_text))
+
+def target_peer(target_channel):
+    """Normalize the target channel into the key used to resolve and cache it"""
+    # Convert channel ID to integer if it's a string and starts with -100
+    if isinstance(target_channel, str) and target_channel.startswith('-100'):
+        return int(target_channel)
+    return target_channel
+
+async def resolve_target_entity(target_channel):
+    """Resolve the channel messages are forwarded to"""
+    target_channel = target_peer(target_channel)
+    target_entity = await _entity(target_channel)
+    logger.debug("Successfully got entity for channel %s", target_channel)
+    return target_entity
+
+async def forward_messages(channel, entity, message_ids, target_entity):
+    """Forward a batch of messages from a channel to the target channel in one request"""
     try:
-        # Convert channel ID to integer if it's a string and starts with -100
-        if isinstance(target_channel, str) and target_channel.startswith('-100'):
-            target_channel = int(target_channel)
-        
-        print(f"Attempting to forward message to channel {target_channel}")
-        target_entity = await client.get_input_entity(target_channel)
-        print(f"Successfully got entity for channel {target_channel}")
-        
-        # Forward the message
-        await client.forward_messages(target_entity, message)
-        print(f"Successfully forwarded message {message.id} to {target_channel}")
+        logger.debug("Attempting to forward %d messages to %s", len(message_ids), TARGET_CHANNEL)
+        await write_client.forward_messages(target_entity, message_ids, from_peer=entity)
+        logger.debug("Successfully forwarded messages %s to %s", message_ids, TARGET_CHANNEL)
         return True
-    except ValueError as e:
-        print(f"Invalid channel format: {e}")
+    except (ChannelPrivateError, ValueError) as e:
+        # Either the source or the target may have failed; drop whichever cached entity is unusable
+        await invalidate_unusable_entities(channel, target_peer(TARGET_CHANNEL))
+        logger.error("Error forwarding message: %s", e)
         return False
     except Exception as e:
-        print(f"Error forwarding message: {e}")
+        logger.error("Error forwarding message: %s", e)
         return False
 
+async def process_channel(channel, check_since, target_entity, forwarded_messages, forwarding_errors):
+    """Fetch messages newer than check_since from one channel and forward matching ones"""
+    logger.debug("Getting messages from %s", channel)
+    
+    # Get the channel entity
+    entity = await _entity(channel)
+    
+    # Get messages
+    try:
+        messages = await read_client.get_messages(entity, limit=10)
+    except (ChannelPrivateError, ValueError):
+        # The cached entity is no longer usable, resolve it again next time
+        _entity.cache_invalidate(channel)
+        raise
+    logger.debug("Fetched %d messages from %s", len(messages), channel)
+    
+    # Channel details are the same for every message
+    channel_title = entity.title
+    channel_username = getattr(entity, 'username', '')
+
+    # Filter and format messages
+    channel_messages = []
+    to_forward = []
+    # Local aliases keep attribute lookups out of the per-message loop
+    _ch_append = channel_messages.append
+    _fw_append = to_forward.append
+    _attr_handler = _ATTR_HANDLERS.get
+    _utc = timezone.utc
+    _offset = _TEHRAN_OFFSET
+    for message in messages:
+        # Convert message.date to timezone-aware UTC if it isn't already
+        msg_date = message.date
+        if msg_date.tzinfo is None:
+            msg_date = msg_date.replace(tzinfo=_utc)
+        
+        if msg_date < check_since:
+            continue
+
+        # Check if message should be forwarded
+        # Media-only messages have no text and are skipped without scanning
+        if target_entity and message.text and should_forward_message(message.text):
+            logger.debug("Message contains keywords, forwarding to %s", TARGET_CHANNEL)
+            _fw_append(message.id)
+
+        # Extract media information
+        media_items = []
+        media = message.media
+        if media:
+            media_type = _MEDIA_TYPE.get(type(media)) or type(media).__name__
+            try:
+                # Handle grouped media
+                if message.grouped_id:
+                    logger.debug("  Message is part of media group %s", message.grouped_id)
+                
+                media_info = {
+                    'type': media_type,
+                    'file_id': None,  # Will be populated below
+                    'mime_type': None,
+                    'file_size': None,
+                    'width': None,     # For photos/videos
+                    'height': None,    # For photos/videos
+                    'duration': None,  # For videos/voice/audio
+                    'title': None,     # For audio files
+                    'performer': None, # For audio files
+                    'grouped_id': message.grouped_id
+                }
+
+                # Handle different types of media
+                if isinstance(media, MessageMediaPhoto):
+                    photo = media.photo
+                    media_info['file_id'] = photo.id
+                    sizes = getattr(photo, 'sizes', None)
+                    if sizes:
+                        # Get the largest photo size
+                        largest_size = sizes[-1]
+                        media_info['width'] = largest_size.w
+                        media_info['height'] = largest_size.h
+                        # For progressive photos, size might be in 'sizes' array
+                        file_size = getattr(largest_size, 'size', None)
+                        if file_size is None:
+                            progressive_sizes = getattr(largest_size, 'sizes', None)
+                            if progressive_sizes:
+                                file_size = progressive_sizes[-1]
+                        media_info['file_size'] = file_size
+                    media_items.append(media_info)
+
+                elif isinstance(media, MessageMediaDocument):
+                    doc = media.document
+                    media_info['file_id'] = doc.id
+                    media_info['file_size'] = doc.size
+                    
+                    # Get mime type if available
+                    media_info['mime_type'] = getattr(doc, 'mime_type', None)
+
+                    # Get video/audio attributes if available
+                    for attr in doc.attributes:
+                        handler = _attr_handler(type(attr))
+                        if handler:
+                            handler(attr, media_info)
+                    media_items.append(media_info)
+
+                logger.debug("  Extracted %d media items", len(media_items))
+            except Exception as e:
+                logger.warning("  Error extracting media info: %s", e)
+                media_items.append({
+                    'type': media_type,
+                    'error': str(e)
+                })
+        
+        message_dict = {
+            'message_id': message.id,
+            'text': message.text or '',
+            'date': (msg_date + _offset).isoformat(),
+            'channel_title': channel_title,
+            'channel_username': channel_username,
+            'sender_id': message.sender_id,
+            'has_media': bool(media),
+            'media': media_items,
+            'views': message.views or 0,
+            'forwards': message.forwards or 0,
+            '_dt': msg_date  # Sort key, removed before the response is sent
+        }
+        _ch_append(message_dict)
+    
+    # Forward all matching messages in a single request
+    if to_forward:
+        try:
+            if await forward_messages(channel, entity, to_forward, target_entity):
+                forwarded_messages.extend(to_forward)
+            else:
+                forwarding_errors.append(f"Failed to forward messages {to_forward}")
+        except Exception as e:
+            forwarding_errors.append(f"Error forwarding messages {to_forward}: {str(e)}")
+
+    # Mark messages as read if we found any
+    if channel_messages:
+        try:
+            await read_client.send_read_acknowledge(entity, max_id=channel_messages[-1]['message_id'])
+            logger.debug("Marked messages as read in channel: %s", channel)
+        except Exception as e:
+            logger.warning("Could not mark messages as read for %s: %s", channel, e)
+
+    logger.debug("Got %d new messages from %s", len(channel_messages), channel)
+    return channel_messages
+
+async def fetch_channel_messages(channels, check_since):
+    """Fetch messages from all channels concurrently and forward matching ones"""
+    all_messages = []
+    forwarded_messages = []
+    forwarding_errors = []
+    
+    # Get messages from all channels
+    for client in (read_client, write_client):
+        if not client.is_connected():
+            await client.connect()
+
+    # Resolve the forwarding target once for the whole request
+    target_entity = None
+    if TARGET_CHANNEL:
+        try:
+            target_entity = await resolve_target_entity(TARGET_CHANNEL)
+        except Exception as e:
+            logger.error("Could not resolve target channel %s: %s", TARGET_CHANNEL, e)
+            forwarding_errors.append(f"Could not resolve target channel {TARGET_CHANNEL}: {str(e)}")
+
+    results = await asyncio.gather(
+        *[process_channel(channel, check_since, target_entity, forwarded_messages, forwarding_errors) for channel in channels],
+        return_exceptions=True
+    )
+    for channel, result in zip(channels, results):
+        if isinstance(result, BaseException):
+            logger.error("Error getting messages from %s: %s", channel, result)
+            continue
+        all_messages.extend(result)
+
+    return all_messages, forwarded_messages, forwarding_errors
+
 @app.route('/get-messages', methods=['POST'])
 async def get_messages():
     """Get new messages from specified channels and forward matching messages"""
     global last_check_time
     
-    # Ensure we have an event loop in this thread
-    loop = get_event_loop()
-    
     try:
-        data = request.json
+        data = await request.get_json()
         channels = data.get('channels', [])
         # Optional parameter to fetch messages from X minutes ago
         minutes_ago = data.get('minutes_ago', None)
         
         if not channels:
-            return jsonify({'error': 'No channels specified'}), 400
+            return ojsonify({'error': 'No channels specified'}, 400)
         
         # Calculate time range
-        current_time = datetime.now(timezone.utc) + timedelta(hours=3.5) # tehran time
+        current_time = datetime.now(timezone.utc)
 
         check_since = current_time - timedelta(minutes=1)
-        print(f"Checking for messages since: {check_since}")
-        
-        all_messages = []
-        forwarded_messages = []
-        forwarding_errors = []
-        
-        # Get messages from all channels
-        async with TelegramClient(SESSION, API_ID, API_HASH, loop=loop) as client:
-            for channel in channels:
-                try:
-                    print(f"Getting messages from {channel}")
-                    
-                    # Get the channel entity
-                    entity = await client.get_entity(channel)
-                    
-                    # Get messages
-                    messages = await client.get_messages(entity, limit=10)
-                    print(f"Fetched {len(messages)} messages from {channel}")
-                    
-                    # Filter and format messages
-                    channel_messages = []
-                    for message in messages:
-                        # Convert message.date to timezone-aware UTC if it isn't already
-                        msg_date = message.date
-                        if msg_date.tzinfo is None:
-                            msg_date = msg_date.replace(tzinfo=timezone.utc)
-                        
-                        # Add 3.5 hours to the message date
-                        msg_date = msg_date + timedelta(hours=3.5)
-                        
-                        if msg_date < check_since:
-                            continue
-
-                        # Check if message should be forwarded
-                        if TARGET_CHANNEL and should_forward_message(message.text):
-                            print(f"Message contains keywords, forwarding to {TARGET_CHANNEL}")
-                            try:
-                                if await forward_message(client, message, TARGET_CHANNEL):
-                                    forwarded_messages.append(message.id)
-                                else:
-                                    forwarding_errors.append(f"Failed to forward message {message.id}")
-                            except Exception as e:
-                                forwarding_errors.append(f"Error forwarding message {message.id}: {str(e)}")
-
-                        # Extract media information
-                        media_items = []
-                        if message.media:
-                            try:
-                                # Handle grouped media
-                                if hasattr(message, 'grouped_id') and message.grouped_id:
-                                    print(f"  Message is part of media group {message.grouped_id}")
-                                
-                                media_info = {
-                                    'type': str(type(message.media).__name__),
-                                    'file_id': None,  # Will be populated below
-                                    'mime_type': None,
-                                    'file_size': None,
-                                    'width': None,     # For photos/videos
-                                    'height': None,    # For photos/videos
-                                    'duration': None,  # For videos/voice/audio
-                                    'title': None,     # For audio files
-                                    'performer': None, # For audio files
-                                    'grouped_id': message.grouped_id if hasattr(message, 'grouped_id') else None
-                                }
-
-                                # Handle different types of media
-                                if hasattr(message.media, 'photo'):
-                                    media_info['file_id'] = message.media.photo.id
-                                    if hasattr(message.media.photo, 'sizes') and message.media.photo.sizes:
-                                        # Get the largest photo size
-                                        largest_size = message.media.photo.sizes[-1]
-                                        media_info['width'] = largest_size.w
-                                        media_info['height'] = largest_size.h
-                                        # For progressive photos, size might be in 'sizes' array
-                                        if hasattr(largest_size, 'size'):
-                                            media_info['file_size'] = largest_size.size
-                                        elif hasattr(largest_size, 'sizes') and largest_size.sizes:
-                                            media_info['file_size'] = largest_size.sizes[-1]
-                                    media_items.append(media_info)
-
-                                elif hasattr(message.media, 'document'):
-                                    doc = message.media.document
-                                    media_info['file_id'] = doc.id
-                                    media_info['file_size'] = doc.size
-                                    
-                                    # Get mime type if available
-                                    if hasattr(doc, 'mime_type'):
-                                        media_info['mime_type'] = doc.mime_type
-
-                                    # Get video/audio attributes if available
-                                    for attr in doc.attributes:
-                                        if hasattr(attr, 'duration'):
-                                            media_info['duration'] = attr.duration
-                                        if hasattr(attr, 'w'):
-                                            media_info['width'] = attr.w
-                                        if hasattr(attr, 'h'):
-                                            media_info['height'] = attr.h
-                                        if hasattr(attr, 'title'):
-                                            media_info['title'] = attr.title
-                                        if hasattr(attr, 'performer'):
-                                            media_info['performer'] = attr.performer
-                                    media_items.append(media_info)
-
-                                print(f"  Extracted {len(media_items)} media items")
-                            except Exception as e:
-                                print(f"  Error extracting media info: {e}")
-                                media_items.append({
-                                    'type': str(type(message.media).__name__),
-                                    'error': str(e)
-                                })
-                        
-                        message_dict = {
-                            'message_id': message.id,
-                            'text': message.text or '',
-                            'date': msg_date.isoformat(),
-                            'channel_title': entity.title,
-                            'channel_username': getattr(entity, 'username', ''),
-                            'sender_id': message.sender_id,
-                            'has_media': bool(message.media),
-                            'media': media_items,
-                            'views': getattr(message, 'views', 0),
-                            'forwards': getattr(message, 'forwards', 0)
-                        }
-                        channel_messages.append(message_dict)
-                    
-                    # Mark messages as read if we found any
-                    if channel_messages:
-                        try:
-                            await client.send_read_acknowledge(entity, max_id=channel_messages[-1]['message_id'])
-                            print(f"Marked messages as read in channel: {channel}")
-                        except Exception as e:
-                            print(f"Could not mark messages as read for {channel}: {e}")
-                    
-                    all_messages.extend(channel_messages)
-                    print(f"Got {len(channel_messages)} new messages from {channel}")
-                    
-                except Exception as e:
-                    print(f"Error getting messages from {channel}: {e}")
+        logger.debug("Checking for messages since: %s", check_since)
         
+        all_messages, forwarded_messages, forwarding_errors = await fetch_channel_messages(channels, check_since)
+
         # Update last check time
         last_check_time = current_time
 
         # Sort all messages by date
-        all_messages.sort(key=lambda x: x['date'])
+        all_messages.sort(key=itemgetter('_dt'))
+        for message_dict in all_messages:
+            del message_dict['_dt']
         
-        return jsonify({
+        payload = {
             'status': 'success',
             'message_count': len(all_messages),
             'messages': all_messages,
-            'last_check': last_check_time.isoformat(),
-            'checked_since': check_since.isoformat(),
+            'last_check': (last_check_time + _TEHRAN_OFFSET).isoformat(),
+            'checked_since': (check_since + _TEHRAN_OFFSET).isoformat(),
             'forwarded_messages': forwarded_messages,
             'forwarded_count': len(forwarded_messages),
             'forwarding_errors': forwarding_errors
-        })
+        }
+        # ?stream=1 serializes the response one message at a time
+        if request.args.get('stream') == '1':
+            return Response(stream_messages(payload), mimetype='application/json')
+        return ojsonify(payload)
         
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}, 500)
 
 @app.route('/status', methods=['GET'])
-def get_status():
+async def get_status():
     """Get service status"""
-    loop = get_event_loop()
-    with TelegramClient(SESSION, API_ID, API_HASH, loop=loop) as client:
-        return jsonify({
-            'client_connected': client.is_connected(),
-            'client_authorized': client.is_user_authorized(),
-            'last_check': last_check_time.isoformat() if last_check_time else None,
-            'status': 'running'
-        })
+    return ojsonify({
+        'client_connected': read_client.is_connected() and write_client.is_connected(),
+        'client_authorized': read_client.is_connected() and await read_client.is_user_authorized(),
+        'last_check': (last_check_time + _TEHRAN_OFFSET).isoformat() if last_check_time else None,
+        'status': 'running'
+    })
 
 @app.route('/get-channel-info', methods=['POST'])
 async def get_channel_info():
     """Get channel information including its ID"""
-    loop = get_event_loop()
-    
     try:
-        data = request.json
+        data = await request.get_json()
         channel_link = data.get('channel_link')
         
         if not channel_link:
-            return jsonify({'error': 'No channel link provided'}), 400
+            return ojsonify({'error': 'No channel link provided'}, 400)
             
-        async with TelegramClient(SESSION, API_ID, API_HASH, loop=loop) as client:
-            try:
-                # Try to get the entity
-                entity = await client.get_entity(channel_link)
-                return jsonify({
-                    'status': 'success',
-                    'channel_id': entity.id,
-                    'channel_title': getattr(entity, 'title', None),
-                    'channel_username': getattr(entity, 'username', None),
-                    'channel_type': type(entity).__name__,
-                    'access_hash': getattr(entity, 'access_hash', None),
-                })
-            except Exception as e:
-                return jsonify({'error': f'Could not get channel info: {str(e)}'}), 404
+        if not read_client.is_connected():
+            await read_client.connect()
+
+        try:
+            # Try to get the entity
+            # Looked up fresh, bypassing the entity cache, so the details are current
+            entity = await read_client.get_entity(channel_link)
+            return ojsonify({
+                'status': 'success',
+                'channel_id': entity.id,
+                'channel_title': getattr(entity, 'title', None),
+                'channel_username': getattr(entity, 'username', None),
+                'channel_type': type(entity).__name__,
+                'access_hash': getattr(entity, 'access_hash', None),
+            })
+        except Exception as e:
+            return ojsonify({'error': f'Could not get channel info: {str(e)}'}, 404)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}, 500)
 
 if __name__ == '__main__':
-    print(f"Starting Flask server on http://0.0.0.0:{os.getenv('FLASK_RUN_PORT', 3002)}")
+    # Development server; in production serve with: hypercorn app:app --bind 0.0.0.0:3002 --workers 1
+    # Hypercorn workers cannot prompt for the login code, so do the first login with python app.py
+    logger.info("Starting Quart server on http://0.0.0.0:%s", os.getenv('FLASK_RUN_PORT', 3002))
     app.run(
         host='0.0.0.0',  # Allow connections from any host
         port=int(os.getenv('FLASK_RUN_PORT', 3002)),
-        debug=True,
-        use_reloader=False  # Important: prevent Flask from starting multiple instances
+        debug=os.getenv('QUART_DEBUG') == '1',
+        use_reloader=False  # Important: prevent Quart from starting multiple instances
     ) 
\ No newline at end of file